@@ -23,7 +23,7 @@
 #######
 
 """
-Process queue implementation using multiprocessing, Queue() and Thread.
+Process queue implementation using multiprocessing, Queue() and connection.wait().
 
 The process queue is responsible to run all requests in actinia that
 require to execute GRASS GIS processes or UNIX processes to create a response.
@@ -32,30 +32,44 @@ The process queue supports logging of the stderr output of the executed processe
 into a rotating logfile and fluent server.
 """
 
+import heapq
 import pickle
 import time
+import functools
 from datetime import datetime
 import queue as standard_queue
-from multiprocessing import Process, Queue
-from threading import Thread, Lock
+from multiprocessing import Process, Queue, Pipe, connection
 import multiprocessing as mp
 import logging
 import logging.handlers
 import platform
+import os
 import sys
 import atexit
+import uuid
 from .resources_logger import ResourceLogger
 
 has_fluent = False
 
 try:
     from fluent import handler
+    from fluent import sender
 
     has_fluent = True
 except:
     print("Fluent is not available")
     has_fluent = False
 
+# Shared memory is available since Python 3.8, large jobs are send
+# through the queue if it is missing
+try:
+    from multiprocessing import resource_tracker
+    from multiprocessing.shared_memory import SharedMemory
+
+    has_shared_memory = True
+except ImportError:
+    has_shared_memory = False
+
 
 __license__ = "GPLv3"
 __author__ = "Sören Gebbert"
@@ -65,6 +79,34 @@ __email__ = "soerengebbert@googlemail.com"
 
 process_queue = Queue()
 process_queue_manager = None
+# The control connection to stop the process queue manager, a new
+# connection is created for each process queue manager
+process_queue_stop_writer = None
+logger = logging.getLogger(__name__)
+
+# Pickled functions and arguments larger than this number of bytes are
+# handed to the job process in shared memory and not via the queue,
+# if shared memory is available
+SHARED_MEMORY_THRESHOLD = 64 * 1024
+# The shared memory blocks of the jobs are named actinia_<pid>_<id> with the
+# id of the process that enqueued the job
+SHARED_MEMORY_PREFIX = "actinia_"
+SHARED_MEMORY_DIR = "/dev/shm"
+
+# The job processes are forked from the warm process queue manager, independent
+# of the platform default start method, so they do not start a new interpreter
+# and inherit the shared memory block that the manager attached for them
+job_process_context = mp.get_context("fork")
+
+# Seconds the running processes have on server shutdown to terminate themselves
+TERMINATION_GRACE_PERIOD = 1.0
+
+# The fluent sender and resource logger of the process queue manager
+# and the id of the process that created them
+_fluent_sender = None
+_fluent_sender_pid = None
+_resource_logger = None
+_resource_logger_pid = None
 
 def create_process_queue(config, use_logger=True):
     """Create the process queue that will start all processes in a separate
@@ -76,11 +118,15 @@ def create_process_queue(config, use_logger=True):
         config: The global configuration
         use_logger: Use the rotating file logger and fluent for stderr logging of the processes
     """
-    global process_queue_manager
+    global process_queue_manager, process_queue_stop_writer
 
     if process_queue_manager is None:
-        p = Process(target=start_process_queue_manager, args=(config, process_queue, use_logger))
+        stop_reader, process_queue_stop_writer = Pipe(duplex=False)
+        p = Process(target=start_process_queue_manager,
+                    args=(config, process_queue, use_logger, stop_reader))
         p.start()
+        # Only the process queue manager reads from the stop connection
+        stop_reader.close()
         process_queue_manager = p
 
 
@@ -91,29 +137,172 @@ def enqueue_job(timeout, func, *args):
         timeout: The timeout of the process, if the timeout is exceeded by the process it will be killed
         func: The function to call from the subprocess
         *args: The function arguments, the first argument must be the RessourceDataContainer
+
+    Raises:
+        pickle.PicklingError, TypeError, AttributeError: If the function or the arguments
+        can not be pickled
     """
-    process_queue.put((func, timeout, args))
+    # The process queue manager only requires these resource attributes
+    header = (args[0].user_id, args[0].resource_id, args[0].config)
+    # Pickle the job in the calling process, so that pickling errors are raised
+    # here and not in the feeder thread of the queue. The function and arguments
+    # are only unpickled by the job process.
+    payload = pickle.dumps((func, args), protocol=pickle.HIGHEST_PROTOCOL)
+    if has_shared_memory is True and len(payload) > SHARED_MEMORY_THRESHOLD:
+        payload = SharedMemoryArguments(payload)
+    try:
+        data = pickle.dumps((header, timeout, payload), protocol=pickle.HIGHEST_PROTOCOL)
+    except:
+        if isinstance(payload, SharedMemoryArguments):
+            payload.unlink()
+        raise
+    process_queue.put(data)
 
 
 def stop_process_queue():
     """Destroy the process queue and terminate all running and enqueued jobs
     """
-    global process_queue_manager
-    # Send stop to the queue
-    process_queue.put("STOP")
+    global process_queue_manager, process_queue_stop_writer
     # Wait for all joining processes
     if process_queue_manager:
-        # print("Waited for process_queue_manager")
-        process_queue_manager.join(3)
-        # print("Terminate process_queue_manager")
-        process_queue_manager.terminate()
-    process_queue_manager = None
+        try:
+            # Send stop via the control connection
+            process_queue_stop_writer.send_bytes(b"STOP")
+        except (BrokenPipeError, OSError):
+            # The process queue manager is not running anymore
+            pass
+        finally:
+            # print("Waited for process_queue_manager")
+            process_queue_manager.join(3)
+            # print("Terminate process_queue_manager")
+            process_queue_manager.terminate()
+            process_queue_stop_writer.close()
+            process_queue_manager = None
+            process_queue_stop_writer = None
 
 
 # Register the stop_process_queue in the exit handler
 atexit.register(stop_process_queue)
 
 
+class SharedMemoryArguments(object):
+    """The pickled function and function arguments of a job stored in a shared memory block
+
+    Only the name of the shared memory block is send through the queue.
+    The manager attaches the block before the job process is started,
+    so that the job process can unpickle the function and its arguments
+    directly from the inherited shared memory.
+
+    The process queue manager is the owner of the shared memory block and
+    must call unlink() when the job process finished or was terminated.
+    The block is not tracked by the resource tracker of the enqueuing process,
+    so it is leaked if the manager never reads the job from the queue, e.g. if
+    the manager died. These blocks are unlinked by the next process queue
+    manager that starts after the enqueuing process exited, see
+    unlink_stale_shared_memory_blocks().
+    """
+
+    def __init__(self, payload):
+        """Copy the pickled function and function arguments into a new shared memory block
+
+        Args:
+            payload (bytes): The pickled (func, args) tuple
+        """
+        self.size = len(payload)
+
+        name = "%s%i_%s" % (SHARED_MEMORY_PREFIX, os.getpid(), uuid.uuid4().hex[:12])
+        shm = SharedMemory(name=name, create=True, size=self.size)
+        shm.buf[:self.size] = payload
+        self.name = shm.name
+        shm.close()
+        # The process queue manager takes care of the shared memory block
+        resource_tracker.unregister(shm._name, "shared_memory")
+
+        self._shm = None
+
+    def attach(self):
+        """Attach the shared memory block in the current process
+        """
+        if self._shm is None:
+            self._shm = SharedMemory(name=self.name)
+
+    def load(self):
+        """Unpickle the function and function arguments from the attached shared memory block
+
+        Returns:
+            tuple:
+            The (func, args) tuple
+        """
+        buf = self._shm.buf[:self.size]
+        try:
+            return pickle.loads(buf)
+        finally:
+            buf.release()
+
+    def unlink(self):
+        """Close and destroy the shared memory block
+        """
+        try:
+            self.attach()
+            self._shm.close()
+            self._shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def unlink_stale_shared_memory_blocks():
+    """Unlink the shared memory blocks of jobs whose enqueuing process does not exist anymore
+
+    Only the enqueuing process can put the job of a shared memory block
+    into the queue, if it does not exist the block can not be read anymore.
+
+    Returns:
+        list:
+        The names of the unlinked shared memory blocks
+    """
+    if not os.path.isdir(SHARED_MEMORY_DIR):
+        return []
+
+    unlinked = []
+    for name in os.listdir(SHARED_MEMORY_DIR):
+        if not name.startswith(SHARED_MEMORY_PREFIX):
+            continue
+        try:
+            pid = int(name[len(SHARED_MEMORY_PREFIX):].split("_")[0])
+        except ValueError:
+            continue
+        try:
+            os.kill(pid, 0)
+            continue
+        except ProcessLookupError:
+            pass
+        except PermissionError:
+            # The process exists but belongs to another user
+            continue
+        try:
+            os.unlink(os.path.join(SHARED_MEMORY_DIR, name))
+            unlinked.append(name)
+        except FileNotFoundError:
+            pass
+    return unlinked
+
+
+def run_job(payload):
+    """Unpickle the function and function arguments of a job and call the function
+
+    This function is the target of the job processes.
+
+    Args:
+        payload: The pickled (func, args) tuple or the attached SharedMemoryArguments
+                 that contain it
+    """
+    if isinstance(payload, SharedMemoryArguments):
+        func, args = payload.load()
+    else:
+        func, args = pickle.loads(payload)
+    return func(*args)
+
+
 class EnqueuedProcess(object):
     """The class that takes care of the handling of a single process. It provides support for timeout check,
     exit status check and resource termination commits. It implements methods to start and gently terminate
@@ -126,35 +315,63 @@ class EnqueuedProcess(object):
     - termination commits - Terminate the process and send an update to the resource database about the termination
     """
 
-    def __init__(self, func, timeout,
+    def __init__(self, header, timeout,
                  resource_logger,
-                 args):
-
-        self.process = Process(target=func, args=args)
+                 payload):
+        """
+        Args:
+            header (tuple): The (user_id, resource_id, config) tuple of the resource
+            timeout: The timeout of the process for waiting to be run
+            resource_logger: The resource logger to send resource updates
+            payload: The pickled (func, args) tuple of the job or the
+                     SharedMemoryArguments that contain it
+        """
+        self.shared_args = None
+        if isinstance(payload, SharedMemoryArguments):
+            self.shared_args = payload
+        self.process = job_process_context.Process(target=run_job, args=(payload,))
         self.timeout = timeout
-        self.config = args[0].config
-        self.resource_id = args[0].resource_id
-        self.user_id = args[0].user_id
-        self.api_info = args[0].api_info
+        self.user_id, self.resource_id, self.config = header
         self.resource_logger = resource_logger
         self.init_time = time.time()
 
         self.started = False
 
-    def __del__(self):
-        pass
-        # print("Process deleted", self.resource_id)
-
     def start(self):
         """Start the process
 
         :return:
         """
-        # print("Start job: ", self.api_info)
+        logger.info("start job %s", self.resource_id)
         self.started = True
+        if self.shared_args is not None:
+            # The job process inherits the attached shared memory block
+            self.shared_args.attach()
         self.process.start()
 
-    def terminate(self, status, message):
+    def release(self):
+        """Release the shared memory block of the function arguments, if any
+
+        Must be called after the process exited or was terminated.
+        """
+        if self.shared_args is not None:
+            self.shared_args.unlink()
+            self.shared_args = None
+
+    def request_termination(self, pipeline=None):
+        """Ask the running process to terminate itself
+
+        The process checks the termination entry of its resource periodically,
+        so it gets the chance to clean up before it exits.
+
+        Args:
+            pipeline: An optional resource logger pipeline to batch the termination request
+        """
+        self.resource_logger.commit_termination(user_id=self.user_id,
+                                                resource_id=self.resource_id,
+                                                pipeline=pipeline)
+
+    def terminate(self, status, message, pipeline=None, now=None):
         """Terminate the process
 
         Send a termination response to the resource database.
@@ -162,90 +379,83 @@ class EnqueuedProcess(object):
         Args:
             status: The status why termination was requested
             message: The message why the process was terminated by the server (timeout, server shutdown, ...)
+            pipeline: An optional resource logger pipeline to batch the resource update
+            now: The optional time.time() timestamp of the resource update
         """
-        # print("Terminate process with message: ", message)
+        logger.info("terminate job %s: %s", self.resource_id, message)
 
         if self.process.is_alive():
             self.process.terminate()
+        self.release()
 
-        self._send_resource_update(status=status, message=message)
-
-    def is_alive(self):
-        return self.process.is_alive()
-
-    def exitcode(self):
-        return self.process.exitcode
-
-    def check_timeout(self):
-        """Check if the process waited longer for running then the timeout that was set
+        self._send_resource_update(status=status, message=message, pipeline=pipeline, now=now)
 
-        Terminate the process if the timeout limit was exceeded.
-
-        Returns:
-             False if within timeout, True if the process terminated itself
-        """
-        # print("Check timeout for process: ", self.api_info)
-        if self.started is False:
-            current_time = time.time()
-            diff = current_time - self.init_time
-            if self.timeout < diff:
-                self.terminate(status="timeout",
-                               message="Processes exceeded timeout (%i) in "
-                                       "waiting queue and was terminated."%self.timeout)
-                return True
-
-        return False
-
-    def check_exit(self):
+    def check_exit(self, pipeline=None, now=None):
         """Check the exitcode, if a non-zero exit code was received then
         send an update to the resource logger that something strange happened.
         Send only if the status of the resource is not "error", "terminated" or "timeout".
 
+        Args:
+            pipeline: An optional resource logger pipeline to batch the resource update
+            now: The optional time.time() timestamp of the resource update
         """
-        if self.process.exitcode is not None and self.process.exitcode is not 0:
+        if self.process.exitcode not in (None, 0):
 
             # Check if the process noticed the error already
             response_data = self.resource_logger.get(self.user_id,
                                                      self.resource_id)
 
             if response_data is not None:
-                http_code, response_model = pickle.loads(response_data)
+                response = pickle.loads(response_data)
+                http_code, response_model = response
                 if response_model["status"] != "error" and \
                         response_model["status"] != "terminated" and \
                         response_model["status"] != "timeout":
                     message = "The process unexpectedly terminated with exit code %i"%self.process.exitcode
-                    self._send_resource_update(status="error", message=message, response_data=response_data)
+                    self._send_resource_update(status="error", message=message, response=response,
+                                               pipeline=pipeline, now=now)
 
-    def _send_resource_update(self, status, message, response_data=None):
+    def _send_resource_update(self, status, message, response=None, pipeline=None, now=None):
         """Send a response to the resource logger about the current resource state
 
         Args:
             status: The status that should be set (terminated)
             message: The message
+            response: The already unpickled [http_code, response_model] of the resource,
+                      it will be fetched from the resource database if None
+            pipeline: An optional resource logger pipeline to batch the resource update
+            now: The time.time() timestamp of the resource update, the current time if None,
+                 so that a batch of updates can share a single timestamp
         """
-        # print("Send resource update status: ", status, " message: ", message)
+        logger.debug("send resource update of job %s status: %s message: %s",
+                     self.resource_id, status, message)
         # Get the latest response and use it as template for the resource update
-        if response_data is None:
+        if response is None:
             response_data = self.resource_logger.get(self.user_id,
                                                      self.resource_id)
+            if response_data is not None:
+                response = pickle.loads(response_data)
 
         # Send the termination response
-        if response_data is not None:
-            http_code, response_model = pickle.loads(response_data)
-            # print("Resource", http_code, response_model)
+        if response is not None:
+            http_code, response_model = response
             response_model["status"] = status
             response_model["message"] = "The process was terminated by the server: %s" % message
             orig_time = response_model["accept_timestamp"]
-            response_model["timestamp"] = time.time()
-            response_model["datetime"] = str(datetime.now())
+            if now is None:
+                now = time.time()
+            response_model["timestamp"] = now
+            response_model["datetime"] = str(datetime.fromtimestamp(now))
             response_model["time_delta"] = response_model["timestamp"] - orig_time
 
-            document = pickle.dumps([http_code, response_model])
+            document = pickle.dumps([http_code, response_model],
+                                    protocol=pickle.HIGHEST_PROTOCOL)
 
             self.resource_logger.commit(user_id=self.user_id,
                                         resource_id=self.resource_id,
                                         document=document,
-                                        expiration=self.config.REDIS_RESOURCE_EXPIRE_TIME)
+                                        expiration=self.config.REDIS_RESOURCE_EXPIRE_TIME,
+                                        pipeline=pipeline)
 
 
 class StreamToLogger(object):
@@ -258,13 +468,58 @@ class StreamToLogger(object):
       self.linebuf = ''
 
     def write(self, buf):
-      for line in buf.rstrip().splitlines():
+      buf = buf.rstrip()
+      if not buf:
+         return
+      for line in buf.splitlines():
          self.logger.log(self.log_level, line.rstrip())
 
     def flush(self):
         pass
 
 
+# The fluentd record format of the worker logger
+FLUENT_RECORD_FORMAT = {
+    'host': '%(hostname)s',
+    'where': '%(module)s.%(funcName)s',
+    'status': '%(levelname)s',
+    'stack_trace': '%(exc_text)s'
+}
+
+
+@functools.lru_cache(maxsize=1)
+def _get_fluent_handler(config):
+    """Create the fluentd handler that is shared by all worker loggers
+
+    Args:
+        config: The global config
+
+    Returns: The fluentd handler
+    """
+    node = platform.node()
+    fh = handler.FluentHandler('%s::actinia.worker' % node,
+                               host=config.LOG_FLUENT_HOST,
+                               port=config.LOG_FLUENT_PORT)
+    fh_formatter = handler.FluentRecordFormatter(FLUENT_RECORD_FORMAT)
+    fh.setFormatter(fh_formatter)
+    return fh
+
+
+@functools.lru_cache(maxsize=None)
+def _get_log_file_handler(log_file_name):
+    """Create the rotating file handler that is shared by all worker loggers
+    writing to the same log file, so that only one handler rotates the file
+
+    Args:
+        log_file_name: The name of the log file
+
+    Returns: The rotating file handler
+    """
+    return logging.handlers.RotatingFileHandler(log_file_name,
+                                                maxBytes=2000000,
+                                                backupCount=5)
+
+
 def create_logger(config, name):
     """Create the multiprocessing logger
 
@@ -283,29 +538,12 @@ def create_logger(config, name):
     logger = logging.getLogger(name=name)
     logger.setLevel(logging.INFO)
 
-    node = platform.node()
-
     if config.LOG_INTERFACE == "fluentd" and has_fluent is True:
-        custom_format = {
-            'host': '%(hostname)s',
-            'where': '%(module)s.%(funcName)s',
-            'status': '%(levelname)s',
-            'stack_trace': '%(exc_text)s'
-        }
-
-        fh = handler.FluentHandler('%s::actinia.worker' % node,
-                                   host=config.LOG_FLUENT_HOST,
-                                   port=config.LOG_FLUENT_PORT)
-        fh_formatter = handler.FluentRecordFormatter(custom_format)
-        fh.setFormatter(fh_formatter)
-        logger.addHandler(fh)
+        logger.addHandler(_get_fluent_handler(config))
 
     # Add the log message handler to the logger
     log_file_name = '%s.log' % (config.WORKER_LOGFILE)
-    lh = logging.handlers.RotatingFileHandler(log_file_name,
-                                              maxBytes=2000000,
-                                              backupCount=5)
-    logger.addHandler(lh)
+    logger.addHandler(_get_log_file_handler(log_file_name))
     logger.info("Logger %s created"%name)
 
     return logger
@@ -325,142 +563,200 @@ def create_stderr_logger(config):
     return
 
 
-def queue_watcher(queue, data_set, lock):
-    """This function runs in a separate thread to check the queue
+def _get_fluent_sender(config):
+    """Get the fluent sender of the current process
+
+    The sender is created on the first call and reused afterwards. A new
+    sender is created in a forked process, so that no socket is shared.
 
     Args:
-        queue: The queue to check
-        data_set: The set to add the received data
-        lock: The lock to be used for locking the set access
+        config: The global config
+
+    Returns:
+        The fluent sender or None if fluent is not available
     """
+    global _fluent_sender, _fluent_sender_pid
 
-    while True:
-        try:
-            # print("Check for new data in queue")
-            data = queue.get(block=True)
-            lock.acquire_lock()
-            data_set.add(data)
-            # print("Add data to set", len(data_set))
-            lock.release_lock()
-        except standard_queue.Empty:
-            pass
+    if has_fluent is False:
+        return None
+
+    pid = os.getpid()
+    if _fluent_sender is None or _fluent_sender_pid != pid:
+        _fluent_sender = sender.FluentSender('actinia_process_logger',
+                                             host=config.LOG_FLUENT_HOST,
+                                             port=config.LOG_FLUENT_PORT)
+        _fluent_sender_pid = pid
+    return _fluent_sender
 
 
-def start_process_queue_manager(config, queue, use_logger):
+def _get_resource_logger(config):
+    """Get the resource logger of the current process that sends
+    updates to the resource database
+
+    The resource logger is created on the first call and reused afterwards.
+    A new resource logger is created in a forked process, so that no redis
+    connection is shared.
+
+    Args:
+        config: The global config
+
+    Returns:
+        ResourceLogger: The resource logger
+    """
+    global _resource_logger, _resource_logger_pid
+
+    pid = os.getpid()
+    if _resource_logger is None or _resource_logger_pid != pid:
+        kwargs = dict()
+        kwargs['host'] = config.REDIS_SERVER_URL
+        kwargs['port'] = config.REDIS_SERVER_PORT
+        if config.REDIS_SERVER_PW and config.REDIS_SERVER_PW is not None:
+            kwargs['password'] = config.REDIS_SERVER_PW
+        _resource_logger = ResourceLogger(**kwargs,
+                                          fluent_sender=_get_fluent_sender(config))
+        _resource_logger_pid = pid
+    return _resource_logger
+
+
+def start_process_queue_manager(config, queue, use_logger, stop_reader):
     """The process queue manager that runs the infinite loop for worker creation
 
     - This function creates the stderr logger if requested
     - It listen to a queue in an infinite loop:
-        - The queue is watched in a separate thread so that no data get lost
-        - Check if new processes are in the data set() that is filled by the queue watcher
+        - Sleep until new data arrives in the queue, a running process exits,
+          the next waiting process exceeds its timeout or stop was requested
         - Check the timeout of waiting processes
         - Enqueue and start new processes
         - Remove finished processes or processes that exceeded their waiting timeout
-        - Stop the queue and exit all running processes if the "STOP" isgnal was send via Queue()
+        - Stop the queue and exit all running and waiting processes if the stop signal
+          was send via the stop connection
 
     Args:
         config: The global config
         queue: The multiprocessing.Queue() object that should be listened to
         use_logger: Create logifle and fluent logger to log the stderr of the processes
+        stop_reader: The multiprocessing.Pipe() connection that signals the stop
     """
-    global finished_procs
-
-    data_set = set()
-    lock = Lock()
-    # Start the thread that permanently listens to the queue
-    queue_thread = Thread(target=queue_watcher, args=(queue, data_set, lock))
-    queue_thread.start()
-
     # Create the logger if required
     if use_logger is True:
         create_stderr_logger(config=config)
 
-    running_procs = set()
-    waiting_processes = set()
+    # Remove the shared memory blocks of jobs that no process queue manager will read
+    if has_shared_memory is True:
+        for name in unlink_stale_shared_memory_blocks():
+            logger.warning("unlinked stale shared memory block %s", name)
+
+    # The running processes keyed by their sentinel
+    running_procs = dict()
+    # Heap of (deadline, id, process) tuples, the process that exceeds its timeout first is on top
+    waiting_processes = []
 
-    fluent_sender = None
-    # Fluentd hack to work in a multiprocessing environment
-    try:
-        from fluent import sender
-        fluent_sender = sender.FluentSender('actinia_process_logger',
-                                            host=config.LOG_FLUENT_HOST,
-                                            port=config.LOG_FLUENT_PORT)
-    except:
-        pass
     # We need the resource logger to send updates to the resource database
-    kwargs = dict()
-    kwargs['host'] = config.REDIS_SERVER_URL
-    kwargs['port'] = config.REDIS_SERVER_PORT
-    if config.REDIS_SERVER_PW and config.REDIS_SERVER_PW is not None:
-        kwargs['password'] = config.REDIS_SERVER_PW
-    resource_logger = ResourceLogger(**kwargs,
-                                     fluent_sender=fluent_sender)
-    del kwargs
-
-    count = 0
+    resource_logger = _get_resource_logger(config)
+
     try:
         while True:
-            # Get the process data from the set that is filled in the queue thread
-            data = None
-            lock.acquire_lock()
-            if len(data_set) > 0:
-                #print("Jobs from queue: ", len(data_set))
-                data = data_set.pop()
-            lock.release_lock()
-
-            if data is not None:
-                # Stop all (running and waiting) processes if the STOP command was detected
-                # and leave the loop
-                if "STOP" in data:
-                    for enqproc in running_procs:
-                        enqproc.terminate(status="error", message="Running process was terminated by server shutdown.")
-                    for enqproc in waiting_processes:
-                        enqproc.terminate(status="error", message="Waiting process was terminated by server shutdown.")
-                    del queue_thread
-                    queue.close()
-                    #print("Exit loop")
-                    exit(0)
-                # Enqueue a new process
-                elif len(data) == 3:
-                    func, timeout, args = data
-                    print("Enqueue process: ", args[0].api_info)
-                    enqproc = EnqueuedProcess(func=func,
-                                              timeout=timeout,
-                                              resource_logger=resource_logger,
-                                              args=args)
-                    waiting_processes.add(enqproc)
-
-            if len(running_procs) < config.NUMBER_OF_WORKERS:
-                if len(waiting_processes) > 0:
-                    enqproc = waiting_processes.pop()
-                    running_procs.add(enqproc)
-                    print("Run process: ", enqproc.api_info)
-                    enqproc.start()
-
-            # Purge processes that are finished or exceeded their timeout each 40th loop
-            if count % 10 == 0:
-                count = 0
-                procs_to_remove = []
-                # purge processes that has been finished
-                for enqproc in running_procs:
-                    if enqproc.started is True and enqproc.is_alive() is False:
+            # Wait at most until the first waiting process exceeds its timeout
+            wait_timeout = None
+            if len(waiting_processes) > 0:
+                deadline = waiting_processes[0][0]
+                wait_timeout = max(0, deadline - time.time())
+
+            # The sentinel of a process becomes ready when the process exits
+            wait_objects = [queue._reader, stop_reader]
+            wait_objects.extend(running_procs)
+            ready = connection.wait(wait_objects, timeout=wait_timeout)
+
+            # Read all process data that arrived in the queue
+            while True:
+                try:
+                    data = queue.get(block=False)
+                except standard_queue.Empty:
+                    break
+
+                header, timeout, payload = pickle.loads(data)
+                enqproc = EnqueuedProcess(header=header,
+                                          timeout=timeout,
+                                          resource_logger=resource_logger,
+                                          payload=payload)
+                heapq.heappush(waiting_processes,
+                               (enqproc.init_time + enqproc.timeout, id(enqproc), enqproc))
+
+            # Stop all (running and waiting) processes if the stop signal was received
+            # and leave the loop, the processes that were just read from the queue are
+            # waiting processes and get a resource update as well
+            if stop_reader in ready:
+                stop_reader.recv_bytes()
+                # Send all termination requests in a single round-trip
+                with resource_logger.pipeline() as pipeline:
+                    for enqproc in running_procs.values():
+                        enqproc.request_termination(pipeline=pipeline)
+                # All running processes share the same grace period to exit,
+                # only the processes whose sentinel is ready are joined
+                deadline = time.time() + TERMINATION_GRACE_PERIOD
+                pending = dict(running_procs)
+                exited_procs = []
+                while len(pending) > 0 and deadline > time.time():
+                    for sentinel in connection.wait(list(pending), timeout=deadline - time.time()):
+                        enqproc = pending.pop(sentinel)
+                        enqproc.process.join()
+                        enqproc.release()
+                        exited_procs.append(enqproc)
+                # Kill the remaining processes and send all resource updates in a single round-trip,
+                # the processes that exited in time keep their final status unless they failed
+                now = time.time()
+                with resource_logger.pipeline() as pipeline:
+                    for enqproc in exited_procs:
+                        enqproc.check_exit(pipeline=pipeline, now=now)
+                    for enqproc in pending.values():
+                        enqproc.terminate(status="error",
+                                          message="Running process was terminated by server shutdown.",
+                                          pipeline=pipeline, now=now)
+                    for deadline, _, enqproc in waiting_processes:
+                        enqproc.terminate(status="error",
+                                          message="Waiting process was terminated by server shutdown.",
+                                          pipeline=pipeline, now=now)
+                queue.close()
+                #print("Exit loop")
+                exit(0)
+
+            # purge processes that has been finished, only their sentinels are ready
+            # the queue reader and the stop connection are not in running_procs
+            finished_procs = [enqproc for enqproc in
+                              (running_procs.pop(sentinel, None) for sentinel in ready)
+                              if enqproc is not None]
+            if len(finished_procs) > 0:
+                # Send the resource updates of all finished processes in a single round-trip
+                now = time.time()
+                with resource_logger.pipeline() as pipeline:
+                    for enqproc in finished_procs:
+                        # The process has exited, join it to receive the exit code
+                        enqproc.process.join()
+                        enqproc.release()
                         # Check if the process finished with an error and send a resource update if required
-                        enqproc.check_exit()
-                        procs_to_remove.append(enqproc)
-                for enqproc in procs_to_remove:
-                    running_procs.remove(enqproc)
-
-                procs_to_remove = []
-                # purge processes that have exceeded their timeout for waiting
-                for enqproc in waiting_processes:
-                    check = enqproc.check_timeout()
-                    if check is True:
-                        procs_to_remove.append(enqproc)
-                for enqproc in procs_to_remove:
-                    waiting_processes.remove(enqproc)
-
-            time.sleep(0.05)
-            count += 1
+                        enqproc.check_exit(pipeline=pipeline, now=now)
+
+            # purge processes that have exceeded their timeout for waiting, the deadline
+            # in the heap decides, so that no popped process is dropped without an update
+            now = time.time()
+            if len(waiting_processes) > 0 and waiting_processes[0][0] < now:
+                with resource_logger.pipeline() as pipeline:
+                    while len(waiting_processes) > 0 and waiting_processes[0][0] < now:
+                        deadline, _, enqproc = heapq.heappop(waiting_processes)
+                        enqproc.terminate(status="timeout",
+                                          message="Processes exceeded timeout (%i) in "
+                                                  "waiting queue and was terminated." % enqproc.timeout,
+                                          pipeline=pipeline, now=now)
+
+            # Start as many waiting processes as workers are available
+            while len(running_procs) < config.NUMBER_OF_WORKERS and len(waiting_processes) > 0:
+                deadline, _, enqproc = heapq.heappop(waiting_processes)
+                enqproc.start()
+                running_procs[enqproc.process.sentinel] = enqproc
+
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("queue state running=%d waiting=%d",
+                             len(running_procs), len(waiting_processes))
     except:
         raise
     finally:
@@ -67,3 +67,14 @@ class RedisBaseInterface(object):
 
     def disconnect(self):
         self.connection_pool.disconnect()
+
+    def pipeline(self):
+        """Create a non-transactional pipeline to batch several commands
+        into a single round-trip to the redis server
+
+        Returns:
+            redis.client.Pipeline:
+            The pipeline, its commands are send when execute() is called
+
+        """
+        return self.redis_server.pipeline(transaction=False)
@@ -115,19 +115,22 @@ class RedisResourceInterface(RedisBaseInterface):
         """
         RedisBaseInterface.__init__(self)
 
-    def set(self, resource_id, resource_entry, expiration=864000):
+    def set(self, resource_id, resource_entry, expiration=864000, pipeline=None):
         """Set or update a resource entry
 
         Args:
             resource_id (str): The unique id of the resource
             resource_entry (str): The entry that should be put in the database
             expiration (int): The time in seconds when this resource should expire
+            pipeline: An optional pipeline created with pipeline() that queues
+                      the command instead of sending it immediately
 
         """
-        return self.redis_server.setex(self.resource_id_prefix + resource_id,
-                                       expiration, resource_entry)
+        redis_server = self.redis_server if pipeline is None else pipeline
+        return redis_server.setex(self.resource_id_prefix + resource_id,
+                                  expiration, resource_entry)
 
-    def set_termination(self, resource_id, expiration=3600):
+    def set_termination(self, resource_id, expiration=3600, pipeline=None):
         """Set or update a resource termination entry
 
         The running job will check for termination periodically and will terminate
@@ -136,10 +139,13 @@ class RedisResourceInterface(RedisBaseInterface):
         Args:
             resource_id (str): The unique id of the resource that should be terminated
             expiration (int): The time in seconds when this resource should expire
+            pipeline: An optional pipeline created with pipeline() that queues
+                      the command instead of sending it immediately
 
         """
-        return self.redis_server.setex(self.resource_id_termination_prefix + resource_id,
-                                       expiration, True)
+        redis_server = self.redis_server if pipeline is None else pipeline
+        return redis_server.setex(self.resource_id_termination_prefix + resource_id,
+                                  expiration, True)
 
     def get(self, resource_id):
         """Get the resource entry if exists
@@ -26,6 +26,7 @@ Resource logger and management interface
 """
 import sys
 import pickle
+from contextlib import contextmanager
 from .redis_resources import RedisResourceInterface
 from .redis_fluentd_logger_base import RedisFluentLoggerBase
 
@@ -62,7 +63,35 @@ class ResourceLogger(RedisFluentLoggerBase):
     def _generate_db_resource_id(user_id, resource_id):
         return "%s/%s" % (user_id, resource_id)
 
-    def commit(self, user_id, resource_id, document, expiration=8640000):
+    @contextmanager
+    def pipeline(self):
+        """Batch resource commits into a single round-trip to the resource database
+
+        The pipeline must be passed to commit() or commit_termination(),
+        all queued commands are send when the context is left::
+
+            with resource_logger.pipeline() as pipeline:
+                resource_logger.commit(user_id, resource_id, document, pipeline=pipeline)
+                resource_logger.commit_termination(user_id, resource_id, pipeline=pipeline)
+
+        The pipelined commits do not report their result, failed commits are
+        reported to stderr when the pipeline was executed.
+
+        Yields:
+            The redis pipeline
+        """
+        pipeline = self.db.pipeline()
+        try:
+            yield pipeline
+            results = pipeline.execute()
+            failed = len([result for result in results if not result])
+            if failed > 0:
+                sys.stderr.write("ResourceLogger ERROR: %i of %i pipelined resource "
+                                 "commits failed\n" % (failed, len(results)))
+        finally:
+            pipeline.reset()
+
+    def commit(self, user_id, resource_id, document, expiration=8640000, pipeline=None):
         """Commit a resource entry to the database, create a new one if it does not exists,
         update existing resource entries
 
@@ -71,15 +100,23 @@ class ResourceLogger(RedisFluentLoggerBase):
             resource_id (str): The resource id
             document (str): The pickled document to store in the database
             expiration (int): Number of seconds of expiration time, default 8640000s hence 100 days
+            pipeline: An optional pipeline created with pipeline(), the entry is
+                      written when the pipeline is executed
 
         Returns:
             bool:
-            True for success, False otherwise
+            True for success, False otherwise, None if the commit was queued in a pipeline
 
         """
 
         db_resource_id = self._generate_db_resource_id(user_id, resource_id)
-        redis_return = bool(self.db.set(db_resource_id, document, expiration))
+        redis_return = self.db.set(db_resource_id, document, expiration,
+                                   pipeline=pipeline)
+        redis_return = bool(redis_return) if pipeline is None else None
+        # The document is only unpickled to be send to the fluentd server
+        if has_fluent is False:
+            return redis_return
+
         log_entry = "empty"
         data = ""
         try:
@@ -96,7 +133,7 @@ class ResourceLogger(RedisFluentLoggerBase):
         finally:
             return redis_return
 
-    def commit_termination(self, user_id, resource_id, expiration=3600):
+    def commit_termination(self, user_id, resource_id, expiration=3600, pipeline=None):
         """Commit a resource entry to the database that requires the termination of the resource,
         create a new one if it does not exists, update existing resource entries
 
@@ -104,15 +141,19 @@ class ResourceLogger(RedisFluentLoggerBase):
             user_id (str): The user id
             resource_id (str): The resource id
             expiration (int): Number of seconds of expiration time, default 3600 hence 1 hour
+            pipeline: An optional pipeline created with pipeline(), the entry is
+                      written when the pipeline is executed
 
         Returns:
             bool:
-            True for success, False otherwise
+            True for success, False otherwise, None if the commit was queued in a pipeline
 
         """
 
         db_resource_id = self._generate_db_resource_id(user_id, resource_id)
-        return bool(self.db.set_termination(db_resource_id, expiration))
+        redis_return = self.db.set_termination(db_resource_id, expiration,
+                                               pipeline=pipeline)
+        return bool(redis_return) if pipeline is None else None
 
     def get(self, user_id, resource_id):
         """Get resource entry
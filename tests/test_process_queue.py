@@ -27,9 +27,19 @@ Tests: process queue test queue
 import unittest
 import time
 import datetime
+import os
+import sys
+import logging
+import pickle
+import queue
+import multiprocessing as mp
+from contextlib import contextmanager
 from copy import deepcopy
+from unittest import mock
+from actinia_core.resources.common import process_queue
 from actinia_core.resources.common.process_queue import create_process_queue,\
-    enqueue_job, stop_process_queue
+    enqueue_job, stop_process_queue, SharedMemoryArguments, SHARED_MEMORY_THRESHOLD,\
+    StreamToLogger
 from actinia_core.resources.common.resource_data_container import ResourceDataContainer
 from actinia_core.resources.common.app import flask_app
 try:
@@ -62,6 +72,87 @@ def job_long_run(rdc):
         time.sleep(3)
 
 
+# The resource updates of the process queue manager and the results of the
+# jobs, both queues are inherited by the forked manager and job processes
+resource_updates = mp.Queue()
+job_results = mp.Queue()
+
+
+def job_report(rdc):
+    job_results.put(rdc.resource_id)
+
+
+def job_sleep(rdc):
+    time.sleep(3)
+
+
+def job_exit_with_error(rdc):
+    sys.exit(3)
+
+
+def job_short_sleep(rdc):
+    time.sleep(0.5)
+
+
+def job_short_sleep_with_error(rdc):
+    time.sleep(0.5)
+    sys.exit(3)
+
+
+def shared_memory_blocks():
+    """Return the names of all existing shared memory blocks
+    """
+    return set(name for name in os.listdir(process_queue.SHARED_MEMORY_DIR)
+               if name.startswith(process_queue.SHARED_MEMORY_PREFIX))
+
+
+def wait_for_no_new_shared_memory_blocks(blocks, timeout=5):
+    """Wait until no shared memory blocks exist besides the provided ones
+
+    Returns:
+        The names of the new shared memory blocks after the timeout
+    """
+    end_time = time.time() + timeout
+    new_blocks = shared_memory_blocks() - blocks
+    while len(new_blocks) > 0 and end_time > time.time():
+        time.sleep(0.1)
+        new_blocks = shared_memory_blocks() - blocks
+    return new_blocks
+
+
+class StubResourceLogger(object):
+    """Resource logger that sends all resource updates of the process
+    queue manager to the test process instead of the resource database
+    """
+
+    def get(self, user_id, resource_id):
+        return pickle.dumps([200, {"status": "running",
+                                   "accept_timestamp": time.time()}])
+
+    def commit(self, user_id, resource_id, document, expiration=None, pipeline=None):
+        http_code, response_model = pickle.loads(document)
+        resource_updates.put((resource_id, response_model["status"]))
+
+    def commit_termination(self, user_id, resource_id, expiration=None, pipeline=None):
+        resource_updates.put((resource_id, "termination_request"))
+
+    @contextmanager
+    def pipeline(self):
+        yield None
+
+
+def get_all(q, timeout):
+    """Receive all entries of a multiprocessing queue that arrive within the timeout
+    """
+    entries = []
+    end_time = time.time() + timeout
+    while True:
+        try:
+            entries.append(q.get(timeout=max(0, end_time - time.time())))
+        except queue.Empty:
+            return entries
+
+
 class ProcessQueueTestCase(unittest.TestCase):
     """
     This class tests the api logging interface
@@ -97,6 +188,13 @@ class ProcessQueueTestCase(unittest.TestCase):
     def tearDown(self):
         self.app_context.pop()
 
+    def enqueue(self, timeout, func, resource_id, **kwargs):
+        args = deepcopy(self.rdc)
+        args.resource_id = resource_id
+        for key, value in kwargs.items():
+            setattr(args, key, value)
+        enqueue_job(timeout, func, args)
+
     def otest_1(self):
 
         create_process_queue(config=global_config, use_logger=False)
@@ -178,5 +276,180 @@ class ProcessQueueTestCase(unittest.TestCase):
         return
 
 
+class ProcessQueueManagerTestCase(ProcessQueueTestCase):
+    """
+    This class tests the process queue manager with a stub resource logger
+    """
+    def setUp(self):
+        ProcessQueueTestCase.setUp(self)
+        get_all(resource_updates, 0)
+        get_all(job_results, 0)
+        # A manager started by a previous test would make create_process_queue()
+        # a no-op and run the jobs with the real resource logger
+        stop_process_queue()
+        # The forked process queue manager inherits the patched resource logger
+        self.patcher = mock.patch.object(process_queue, "_get_resource_logger",
+                                         return_value=StubResourceLogger())
+        self.patcher.start()
+        create_process_queue(config=global_config, use_logger=False)
+
+    def tearDown(self):
+        stop_process_queue()
+        self.patcher.stop()
+        ProcessQueueTestCase.tearDown(self)
+
+    @unittest.skipUnless(process_queue.has_shared_memory and os.path.isdir("/dev/shm"),
+                         "requires shared memory in /dev/shm")
+    def test_shared_memory_released_after_finish(self):
+        blocks = shared_memory_blocks()
+        self.enqueue(10, job_report, "large", request_data="x" * 2 * SHARED_MEMORY_THRESHOLD)
+        self.assertEqual(job_results.get(timeout=10), "large")
+        self.assertEqual(wait_for_no_new_shared_memory_blocks(blocks), set())
+
+    @unittest.skipUnless(process_queue.has_shared_memory and os.path.isdir("/dev/shm"),
+                         "requires shared memory in /dev/shm")
+    def test_shared_memory_released_after_timeout(self):
+        blocks = shared_memory_blocks()
+        # The single worker is busy, so that the large job exceeds its waiting timeout
+        self.enqueue(10, job_sleep, "busy")
+        time.sleep(0.5)
+        self.enqueue(1, job_report, "large", request_data="x" * 2 * SHARED_MEMORY_THRESHOLD)
+        self.assertIn(("large", "timeout"), get_all(resource_updates, 3))
+        self.assertEqual(wait_for_no_new_shared_memory_blocks(blocks), set())
+
+    def test_timeout_in_waiting_queue(self):
+        # The single worker is busy, so that both jobs exceed their waiting timeout
+        self.enqueue(10, job_sleep, "busy")
+        time.sleep(0.5)
+        self.enqueue(0, job_report, "expired")
+        self.enqueue(1, job_report, "waiting")
+        updates = get_all(resource_updates, 2)
+        self.assertEqual(updates.count(("expired", "timeout")), 1)
+        self.assertEqual(updates.count(("waiting", "timeout")), 1)
+        self.assertEqual(get_all(job_results, 0), [])
+
+    def test_exit_with_error(self):
+        self.enqueue(10, job_exit_with_error, "failing")
+        self.assertIn(("failing", "error"), get_all(resource_updates, 3))
+
+    def test_exit_without_error(self):
+        self.enqueue(10, job_report, "succeeding")
+        self.assertEqual(job_results.get(timeout=10), "succeeding")
+        self.assertEqual(get_all(resource_updates, 1), [])
+
+    def test_stop_within_grace_period(self):
+        # Restart the manager, so that both jobs are running
+        stop_process_queue()
+        global_config.NUMBER_OF_WORKERS = 2
+        create_process_queue(config=global_config, use_logger=False)
+
+        self.enqueue(10, job_short_sleep, "finishing")
+        self.enqueue(10, job_short_sleep_with_error, "failing")
+        time.sleep(0.2)
+        stop_process_queue()
+
+        updates = get_all(resource_updates, 1)
+        self.assertIn(("finishing", "termination_request"), updates)
+        self.assertIn(("failing", "termination_request"), updates)
+        # The finished process keeps its status, the failed one gets an error update
+        self.assertNotIn(("finishing", "error"), updates)
+        self.assertIn(("failing", "error"), updates)
+
+    def test_stop_after_grace_period(self):
+        self.enqueue(10, job_sleep, "running")
+        time.sleep(0.2)
+        stop_process_queue()
+
+        updates = get_all(resource_updates, 1)
+        self.assertIn(("running", "termination_request"), updates)
+        self.assertIn(("running", "error"), updates)
+
+    def test_stop_after_manager_died(self):
+        process_queue.process_queue_manager.kill()
+        process_queue.process_queue_manager.join(3)
+
+        stop_process_queue()
+        self.assertIsNone(process_queue.process_queue_manager)
+        self.assertIsNone(process_queue.process_queue_stop_writer)
+
+    def test_restart(self):
+        self.enqueue(10, job_report, "first")
+        self.assertEqual(job_results.get(timeout=10), "first")
+
+        stop_process_queue()
+        create_process_queue(config=global_config, use_logger=False)
+
+        # The new manager must not receive the stop signal of the previous one
+        self.enqueue(10, job_report, "second")
+        self.assertEqual(job_results.get(timeout=10), "second")
+        self.assertTrue(process_queue.process_queue_manager.is_alive())
+
+
+@unittest.skipUnless(process_queue.has_shared_memory and os.path.isdir("/dev/shm"),
+                     "requires shared memory in /dev/shm")
+class SharedMemoryArgumentsTestCase(unittest.TestCase):
+    """
+    This class tests the shared memory hand-over of the job arguments
+    """
+    def test_round_trip(self):
+        payload = pickle.dumps((job_report, ("a", 1)))
+        shared_args = SharedMemoryArguments(payload)
+        self.assertIn(shared_args.name, shared_memory_blocks())
+
+        # Only the name and size are send through the queue
+        shared_args = pickle.loads(pickle.dumps(shared_args))
+        shared_args.attach()
+        func, args = shared_args.load()
+        self.assertEqual(func, job_report)
+        self.assertEqual(args, ("a", 1))
+
+        shared_args.unlink()
+        self.assertNotIn(shared_args.name, shared_memory_blocks())
+
+    def test_unlink_without_attach(self):
+        shared_args = SharedMemoryArguments(pickle.dumps(("a", 1)))
+        shared_args.unlink()
+        self.assertNotIn(shared_args.name, shared_memory_blocks())
+        # A second unlink of the destroyed block is ignored
+        shared_args.unlink()
+
+    def test_unlink_stale_blocks(self):
+        # The pid of an exited process
+        p = mp.Process(target=time.sleep, args=(0,))
+        p.start()
+        p.join()
+        stale_args = SharedMemoryArguments(pickle.dumps(("a", 1)))
+        stale_name = stale_args.name.replace("_%i_" % os.getpid(), "_%i_" % p.pid)
+        os.rename(os.path.join(process_queue.SHARED_MEMORY_DIR, stale_args.name),
+                  os.path.join(process_queue.SHARED_MEMORY_DIR, stale_name))
+        shared_args = SharedMemoryArguments(pickle.dumps(("a", 1)))
+
+        unlinked = process_queue.unlink_stale_shared_memory_blocks()
+        self.assertIn(stale_name, unlinked)
+        self.assertNotIn(stale_name, shared_memory_blocks())
+        # The blocks of existing processes are kept
+        self.assertIn(shared_args.name, shared_memory_blocks())
+        shared_args.unlink()
+
+
+class StreamToLoggerTestCase(unittest.TestCase):
+    """
+    This class tests the stderr redirection to the logger
+    """
+    def test_write(self):
+        logger = mock.Mock()
+        stream = StreamToLogger(logger, logging.ERROR)
+
+        # The empty writes of print() are not logged
+        stream.write("")
+        stream.write("\n")
+        logger.log.assert_not_called()
+
+        stream.write("line 1\nline 2  \n")
+        self.assertEqual(logger.log.call_args_list,
+                         [mock.call(logging.ERROR, "line 1"),
+                          mock.call(logging.ERROR, "line 2")])
+
+
 if __name__ == '__main__':
     unittest.main()
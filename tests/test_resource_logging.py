@@ -178,5 +178,38 @@ class ResourceLoggingTestCase(ActiniaResourceTestCaseBase):
 
         self.assertFalse(ret)
 
+    def test_pipeline(self):
+
+        with self.log.pipeline() as pipeline:
+            ret = self.log.commit(user_id=self.user_id,
+                                  resource_id=self.resource_id,
+                                  document=self.document,
+                                  pipeline=pipeline)
+            # Pipelined commits do not report their result
+            self.assertIsNone(ret)
+
+            ret = self.log.commit_termination(user_id=self.user_id,
+                                              resource_id=self.resource_id,
+                                              pipeline=pipeline)
+            self.assertIsNone(ret)
+
+            # Nothing is written before the pipeline is executed
+            doc = self.log.get(user_id=self.user_id,
+                               resource_id=self.resource_id)
+            self.assertEqual(None, doc)
+
+        doc = self.log.get(user_id=self.user_id,
+                           resource_id=self.resource_id)
+        self.assertEqual(self.document, doc)
+
+        ret = self.log.get_termination(user_id=self.user_id,
+                                       resource_id=self.resource_id)
+        self.assertEqual(True, ret)
+
+        self.log.delete(user_id=self.user_id,
+                        resource_id=self.resource_id)
+        self.log.delete_termination(user_id=self.user_id,
+                                    resource_id=self.resource_id)
+
 if __name__ == '__main__':
     unittest.main()